@@ -4,24 +4,102 @@ Programmatic expansion that actually creates DIFFERENT examples.
 Substitutes entities, relations, and formats based on domain mappings.
 """
 
-import json
+import orjson
 import yaml
 import random
 import re
 import sys
+import multiprocessing as mp
 from pathlib import Path
-from copy import deepcopy
-from typing import Dict, List, Any
+from string import Template
+from functools import lru_cache, partial
+from typing import Dict, Iterator, List, Optional, Tuple, Any
 from template_rules import TEMPLATE_RULES
 
 
+# libyaml's C loader is several times faster than the pure-Python one
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+@lru_cache(maxsize=4)
+def _load_config(path: str) -> Dict:
+    """Parse a domain mappings YAML file once per process."""
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
+
+@lru_cache(maxsize=4096)
+def _word_pattern(token: str) -> re.Pattern:
+    """Compiled whole-word pattern for a literal token (cached per token)."""
+    return re.compile(rf'\b{re.escape(token)}\b')
+
+
+@lru_cache(maxsize=4096)
+def _alternation_pattern(tokens: frozenset) -> re.Pattern:
+    """Compiled whole-word pattern matching any of the tokens, longest first."""
+    ordered = sorted(tokens, key=lambda t: (-len(t), t))
+    return re.compile(r'\b(' + '|'.join(re.escape(t) for t in ordered) + r')\b')
+
+
+def _substitute_all(text: str, mapping: Dict[str, str]) -> Tuple[str, int]:
+    """Replace every whole-word occurrence of the mapping keys in a single pass.
+    
+    Returns the new text and the number of replacements made.
+    """
+    if not mapping:
+        return text, 0
+    pattern = _alternation_pattern(frozenset(mapping))
+    return pattern.subn(lambda m: mapping[m.group(1)], text)
+
+
+@lru_cache(maxsize=4096)
+def _entity_template(text: str, names: tuple) -> Optional[Template]:
+    """Text with each whole-word entity name replaced by a ${E<i>} placeholder.
+    
+    Returns None when no entity name occurs in the text.
+    """
+    pieces = []
+    last = 0
+    index = {name: i for i, name in enumerate(names)}
+    for match in _alternation_pattern(frozenset(names)).finditer(text):
+        pieces.append(text[last:match.start()].replace('$', '$$'))
+        pieces.append(f'${{E{index[match.group(1)]}}}')
+        last = match.end()
+    if not pieces:
+        return None
+    pieces.append(text[last:].replace('$', '$$'))
+    return Template(''.join(pieces))
+
+
+def _render_entities(text: str, mapping: Dict[str, str]) -> str:
+    """Substitute entity names via the cached per-text placeholder template.
+    
+    Returns the same object when no entity name occurs in the text.
+    """
+    if not mapping:
+        return text
+    names = tuple(sorted(mapping))
+    template = _entity_template(text, names)
+    if template is None:
+        return text
+    return template.substitute(
+        {f'E{i}': mapping[name] for i, name in enumerate(names)}
+    )
+
+
 class ExampleExpander:
     """Expands seed examples into domain-specific variants."""
     
     def __init__(self, domain_mappings_path: str = "data/expansion/domain_mappings.yaml"):
-        with open(domain_mappings_path, 'r') as f:
-            config = yaml.safe_load(f)
-            self.domains = config['domains']
+        config = _load_config(domain_mappings_path)
+        # Copy each domain so derived keys below don't leak into the cached config
+        self.domains = {name: dict(dc) for name, dc in config['domains'].items()}
+        
+        # Flatten entity example groups once per domain
+        for domain_config in self.domains.values():
+            domain_config['_flat_entities'] = [
+                entity for group in domain_config['entity_examples'] for entity in group
+            ]
         
         # Track used entity pairs to avoid duplicates
         self.used_pairs = set()
@@ -42,7 +120,8 @@ class ExampleExpander:
             raise ValueError(f"Unknown domain: {target_domain}")
         
         domain_config = self.domains[target_domain]
-        new_example = deepcopy(seed_example)
+        # Shallow copy is enough: input and output are replaced below
+        new_example = dict(seed_example)
         
         # Get template rules
         template_id = seed_example['template_id']
@@ -59,11 +138,24 @@ class ExampleExpander:
             variant_id
         )
         
+        # Draw each type/relation variant once so the input and output agree
+        type_choices = {
+            old_type: random.choice(new_types)
+            for old_type, new_types in domain_config['entity_types'].items()
+        }
+        relation_choices = {}
+        for relation in original_relations:
+            old_relation = relation['relation_type']
+            variants = domain_config['relations'].get(old_relation)
+            if variants and old_relation not in relation_choices:
+                relation_choices[old_relation] = random.choice(variants)
+        
         # Substitute in input text
         new_input = self._substitute_input_text(
             seed_example['input'],
             entity_mapping,
-            domain_config,
+            type_choices,
+            relation_choices,
             original_relations
         )
         
@@ -71,7 +163,8 @@ class ExampleExpander:
         new_output = self._substitute_output(
             seed_example['output'],
             entity_mapping,
-            domain_config,
+            type_choices,
+            relation_choices,
             new_input
         )
         
@@ -92,6 +185,9 @@ class ExampleExpander:
     ) -> Dict[str, str]:
         """Create mapping from original entity names to new domain-specific names."""
         mapping = {}
+        entity_types = domain_config['entity_types']
+        # Available entities for this domain (flattened at load time)
+        flat_entities = domain_config['_flat_entities']
         
         # Group entities by type
         entities_by_type = {}
@@ -103,15 +199,7 @@ class ExampleExpander:
         
         # Select random entities from domain's entity pool
         for etype, entity_texts in entities_by_type.items():
-            if etype == "Company" or etype in domain_config['entity_types']:
-                # Get available entities for this domain
-                available_entities = domain_config['entity_examples']
-                
-                # Flatten if nested
-                flat_entities = []
-                for group in available_entities:
-                    flat_entities.extend(group)
-                
+            if etype == "Company" or etype in entity_types:
                 # Ensure we have enough unique entities
                 if len(entity_texts) > len(flat_entities):
                     # Cycle through if needed
@@ -139,57 +227,60 @@ class ExampleExpander:
         self,
         original_input: str,
         entity_mapping: Dict[str, str],
-        domain_config: Dict,
+        type_choices: Dict[str, str],
+        relation_choices: Dict[str, str],
         original_relations: List[Dict]
     ) -> str:
-        """Substitute entities and relations in input text."""
-        new_input = original_input
+        """Substitute entities and relations in input text.
+        
+        Returns original_input itself when nothing was substituted.
+        """
+        # Person names map to themselves; don't spend a regex pass on them
+        entity_mapping = {old: new for old, new in entity_mapping.items() if old != new}
         
         # Substitute entities (longest first to avoid partial matches)
-        sorted_entities = sorted(entity_mapping.items(), key=lambda x: len(x[0]), reverse=True)
-        for old_name, new_name in sorted_entities:
-            new_input = re.sub(
-                rf'\b{re.escape(old_name)}\b',
-                new_name,
-                new_input
-            )
+        new_input = _render_entities(original_input, entity_mapping)
+        changed = new_input is not original_input
         
         # Substitute relation types if present
         if original_relations:
             for relation in original_relations:
                 old_relation = relation['relation_type']
                 
-                # Get domain-specific relation variants
-                if old_relation in domain_config['relations']:
-                    new_relation = random.choice(domain_config['relations'][old_relation])
-                    new_input = re.sub(
-                        rf'\b{re.escape(old_relation)}\b',
+                # Domain-specific relation variant drawn for this example
+                new_relation = relation_choices.get(old_relation)
+                if new_relation is not None and old_relation in new_input:
+                    new_input, n = _word_pattern(old_relation).subn(
                         new_relation,
                         new_input,
                         count=1  # Only replace first occurrence
                     )
+                    changed = changed or n > 0
         
         # Update entity type mentions (Company -> Hospital, etc.)
-        for old_type, new_types in domain_config['entity_types'].items():
-            if old_type in new_input:
-                new_type = random.choice(new_types)
-                new_input = re.sub(
-                    rf'\b{old_type}\b',
-                    new_type,
-                    new_input
-                )
+        type_mapping = {
+            old_type: new_type
+            for old_type, new_type in type_choices.items()
+            if old_type in new_input
+        }
+        new_input, n = _substitute_all(new_input, type_mapping)
+        changed = changed or n > 0
         
-        return new_input
+        return new_input if changed else original_input
     
     def _substitute_output(
         self,
         original_output: Dict,
         entity_mapping: Dict[str, str],
-        domain_config: Dict,
+        type_choices: Dict[str, str],
+        relation_choices: Dict[str, str],
         new_input: str
     ) -> Dict:
         """Substitute entities and relations in output JSON."""
-        new_output = deepcopy(original_output)
+        # Entities and relations are flat dicts; copy one level instead of deepcopy
+        new_output = dict(original_output)
+        new_output['entities'] = [dict(e) for e in original_output['entities']]
+        new_output['relations'] = [dict(r) for r in original_output['relations']]
         
         # Substitute entity texts and types
         for entity in new_output['entities']:
@@ -198,40 +289,29 @@ class ExampleExpander:
                 entity['text'] = entity_mapping[old_text]
             
             # Update entity type to domain-specific type
-            old_type = entity['type']
-            if old_type in domain_config['entity_types']:
-                entity['type'] = random.choice(domain_config['entity_types'][old_type])
+            new_type = type_choices.get(entity['type'])
+            if new_type is not None:
+                entity['type'] = new_type
         
         # Substitute in relations
         for relation in new_output['relations']:
             # Update relation type
             old_relation_type = relation['relation_type']
-            if old_relation_type in domain_config['relations']:
-                relation['relation_type'] = random.choice(
-                    domain_config['relations'][old_relation_type]
-                )
+            new_relation_type = relation_choices.get(old_relation_type)
+            if new_relation_type is not None:
+                relation['relation_type'] = new_relation_type
             
             # Update evidence text
             old_evidence = relation['evidence']
             new_evidence = old_evidence
             
             # Substitute entity names in evidence
-            for old_name, new_name in entity_mapping.items():
-                new_evidence = re.sub(
-                    rf'\b{re.escape(old_name)}\b',
-                    new_name,
-                    new_evidence
-                )
+            new_evidence = _render_entities(new_evidence, entity_mapping)
             
             # Substitute relation type in evidence
             if old_relation_type in new_evidence:
                 new_rel = relation['relation_type']  # Already updated above
-                new_evidence = re.sub(
-                    rf'\b{re.escape(old_relation_type)}\b',
-                    new_rel,
-                    new_evidence,
-                    count=1
-                )
+                new_evidence = new_evidence.replace(old_relation_type, new_rel, 1)
             
             relation['evidence'] = new_evidence
         
@@ -282,7 +362,55 @@ def generate_variants(
     return variants
 
 
-def main(template_file: str, output_file: str, num_variants: int = 5):
+# Per-process expander, built once by _init_worker
+_worker_expander = None
+
+
+def _init_worker(domain_mappings_path: str):
+    """Pool initializer: load domain mappings once per worker process."""
+    global _worker_expander
+    # Forked workers inherit the parent's RNG state; reseed so they diverge
+    random.seed()
+    _worker_expander = ExampleExpander(domain_mappings_path)
+
+
+def _expand_seed(seed_example: Dict, num_variants_per_domain: int) -> List[Dict]:
+    """Pool task: expand one seed example with this worker's expander."""
+    return generate_variants(seed_example, _worker_expander, num_variants_per_domain)
+
+
+def _iter_variants(
+    seed_examples: List[Dict],
+    num_variants: int,
+    num_workers: int,
+    expander: ExampleExpander,
+    domain_mappings_path: str
+) -> Iterator[List[Dict]]:
+    """Yield the variants of each seed example, in seed order.
+    
+    The given expander is used without a pool; pool workers build their own.
+    """
+    if num_workers > 1:
+        chunksize = max(1, len(seed_examples) // (num_workers * 4))
+        with mp.Pool(
+            num_workers,
+            initializer=_init_worker,
+            initargs=(domain_mappings_path,)
+        ) as pool:
+            task = partial(_expand_seed, num_variants_per_domain=num_variants)
+            yield from pool.imap(task, seed_examples, chunksize=chunksize)
+    else:
+        for seed_example in seed_examples:
+            yield generate_variants(seed_example, expander, num_variants)
+
+
+def main(
+    template_file: str,
+    output_file: str,
+    num_variants: int = 5,
+    num_workers: int = None,
+    domain_mappings_path: str = "data/expansion/domain_mappings.yaml"
+):
     """
     Generate expanded dataset from template file.
     
@@ -290,52 +418,57 @@ def main(template_file: str, output_file: str, num_variants: int = 5):
         template_file: Path to template JSONL file (e.g., template_01.jsonl)
         output_file: Path to output expanded JSONL file
         num_variants: Number of variants per domain
+        num_workers: Worker processes for expansion (default: CPU count, 1 = no pool)
+        domain_mappings_path: Path to domain mappings YAML
     """
     print(f"Expanding {template_file}...")
     
-    # Load expander
-    expander = ExampleExpander()
+    if num_workers is None:
+        num_workers = mp.cpu_count()
+    
+    # Load expander before touching the output file, so config errors surface
+    # here; pool workers then reuse the cached config inherited on fork
+    expander = ExampleExpander(domain_mappings_path)
     
     # Load seed examples
     seed_examples = []
-    with open(template_file, 'r', encoding='utf-8') as f:
+    with open(template_file, 'rb') as f:
         for line in f:
             if line.strip():
-                seed_examples.append(json.loads(line))
+                seed_examples.append(orjson.loads(line))
     
     print(f"Loaded {len(seed_examples)} seed examples")
     
-    # Generate variants
-    all_variants = []
-    for seed_example in seed_examples:
-        variants = generate_variants(seed_example, expander, num_variants)
-        all_variants.extend(variants)
-        print(f"  Generated {len(variants)} variants for seed example")
-    
-    # Save expanded dataset
+    # Save expanded dataset, streaming variants as they are generated
     output_path = Path(output_file)
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
-    with open(output_file, 'w', encoding='utf-8') as f:
+    num_generated = 0
+    with open(output_file, 'wb') as f:
         # Write seed examples first
         for seed in seed_examples:
-            f.write(json.dumps(seed, ensure_ascii=False) + '\n')
+            f.write(orjson.dumps(seed))
+            f.write(b'\n')
         
         # Write variants
-        for variant in all_variants:
-            f.write(json.dumps(variant, ensure_ascii=False) + '\n')
+        for variants in _iter_variants(seed_examples, num_variants, num_workers, expander, domain_mappings_path):
+            for variant in variants:
+                f.write(orjson.dumps(variant))
+                f.write(b'\n')
+            num_generated += len(variants)
+            print(f"  Generated {len(variants)} variants for seed example")
     
-    total = len(seed_examples) + len(all_variants)
+    total = len(seed_examples) + num_generated
     print(f"\n✅ Expansion complete!")
     print(f"   Seed examples: {len(seed_examples)}")
-    print(f"   Generated variants: {len(all_variants)}")
+    print(f"   Generated variants: {num_generated}")
     print(f"   Total examples: {total}")
     print(f"   Saved to: {output_file}")
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
-        print("Usage: python scripts/generate_examples.py <input_template.jsonl> <output.jsonl> [num_variants]")
+        print("Usage: python scripts/generate_examples.py <input_template.jsonl> <output.jsonl> [num_variants] [num_workers]")
         print("\nExample:")
         print("  python scripts/generate_examples.py data/train/template_01.jsonl data/train/expanded/template_01_expanded.jsonl 5")
         sys.exit(1)
@@ -343,5 +476,6 @@ if __name__ == "__main__":
     input_file = sys.argv[1]
     output_file = sys.argv[2]
     num_variants = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    num_workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
     
-    main(input_file, output_file, num_variants)
\ No newline at end of file
+    main(input_file, output_file, num_variants, num_workers)
\ No newline at end of file
@@ -4,32 +4,72 @@ Use Qwen 2.5 to augment training examples through linguistic variation.
 Qwen rewrites INPUT text only. Output labels remain unchanged.
 """
 
-import json
+import os
 import sys
 import random
+import hashlib
+import tempfile
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from copy import deepcopy
 
+import orjson
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
 
 
 class QwenAugmenter:
     """Uses Qwen to create linguistic variations of training examples."""
     
-    def __init__(self, model_name: str = "Qwen/Qwen2.5-3B-Instruct"):
+    def __init__(
+        self,
+        model_name: str = "Qwen/Qwen2.5-3B-Instruct",
+        attn_implementation: str = None,
+        load_in_4bit: bool = False,
+        deterministic: bool = False,
+        cache_dir: str = "cache/qwen"
+    ):
         """
         Initialize Qwen model for text augmentation.
         
         Args:
             model_name: Hugging Face model ID
+            attn_implementation: Attention kernel (default: flash_attention_2
+                if installed, otherwise sdpa)
+            load_in_4bit: Load NF4-quantized weights via bitsandbytes
+            deterministic: Use greedy decoding and cache generations on disk
+            cache_dir: Directory for cached generations (deterministic only)
         """
-        print(f"Loading {model_name}...")
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if attn_implementation is None:
+            attn_implementation = "flash_attention_2" if is_flash_attn_2_available() else "sdpa"
+        
+        self.model_name = model_name
+        self.deterministic = deterministic
+        # Sampled generations differ per call, so only greedy output is cacheable
+        self.cache_dir = Path(cache_dir) if deterministic and cache_dir else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        
+        print(f"Loading {model_name} ({attn_implementation})...")
+        # Left padding keeps generated tokens aligned across a batch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side="left")
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        
+        quantization_config = None
+        if load_in_4bit:
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_quant_type="nf4"
+            )
+        
         self.model = AutoModelForCausalLM.from_pretrained(
             model_name,
             torch_dtype=torch.bfloat16,
+            attn_implementation=attn_implementation,
+            quantization_config=quantization_config,
             device_map="auto"
         )
         print("✅ Model loaded")
@@ -51,36 +91,61 @@ class QwenAugmenter:
         Returns:
             Augmented example with rewritten input, same output
         """
-        # Extract content section from canonical input
-        original_input = example['input']
-        content_section = self._extract_content(original_input)
+        return self.augment_batch([(example, augmentation_type, variant_num)])[0]
+    
+    def augment_batch(
+        self,
+        requests: List[Tuple[Dict, str, int]],
+        max_new_tokens: int = 200
+    ) -> List[Dict]:
+        """
+        Create augmented variants for several examples in one generate call.
+        
+        Args:
+            requests: (example, augmentation_type, variant_num) tuples
+            max_new_tokens: Generation budget per example
+        
+        Returns:
+            Augmented examples, in the same order as requests
+        """
+        # Extract content sections and build prompts
+        prompts = []
+        for example, augmentation_type, _ in requests:
+            content_section = self._extract_content(example['input'])
+            prompts.append(self._build_prompt(content_section, augmentation_type))
+        
+        generations = self._generate_batch(prompts, max_new_tokens=max_new_tokens)
+        
+        augmented = []
+        for (example, augmentation_type, variant_num), augmented_content in zip(requests, generations):
+            # Reconstruct full input with metadata
+            new_input = self._reconstruct_input(
+                example['input'],
+                augmented_content
+            )
+            
+            # Create new example
+            new_example = deepcopy(example)
+            new_example['input'] = new_input
+            # Keep output unchanged!
+            new_example['augmentation_type'] = augmentation_type
+            new_example['augmentation_variant'] = variant_num
+            augmented.append(new_example)
         
-        # Generate augmentation based on type
+        return augmented
+    
+    def _build_prompt(self, text: str, augmentation_type: str) -> str:
+        """Build the rewrite prompt for an augmentation type."""
         if augmentation_type == "paraphrase":
-            augmented_content = self._paraphrase(content_section)
+            return self._paraphrase_prompt(text)
         elif augmentation_type == "noise":
-            augmented_content = self._add_noise(content_section)
+            return self._noise_prompt(text)
         elif augmentation_type == "formal":
-            augmented_content = self._make_formal(content_section)
+            return self._formal_prompt(text)
         elif augmentation_type == "informal":
-            augmented_content = self._make_informal(content_section)
+            return self._informal_prompt(text)
         else:
             raise ValueError(f"Unknown augmentation type: {augmentation_type}")
-        
-        # Reconstruct full input with metadata
-        new_input = self._reconstruct_input(
-            original_input,
-            augmented_content
-        )
-        
-        # Create new example
-        new_example = deepcopy(example)
-        new_example['input'] = new_input
-        # Keep output unchanged!
-        new_example['augmentation_type'] = augmentation_type
-        new_example['augmentation_variant'] = variant_num
-        
-        return new_example
     
     def _extract_content(self, canonical_input: str) -> str:
         """Extract content section from canonical input format."""
@@ -101,20 +166,18 @@ class QwenAugmenter:
         
         return '\n'.join(clean_lines).strip()
     
-    def _paraphrase(self, text: str) -> str:
-        """Paraphrase text while keeping meaning."""
-        prompt = f"""Rewrite the following text in different words while keeping the exact same meaning and entities. Do not add or remove any information. Do not add explanations.
+    def _paraphrase_prompt(self, text: str) -> str:
+        """Prompt to paraphrase text while keeping meaning."""
+        return f"""Rewrite the following text in different words while keeping the exact same meaning and entities. Do not add or remove any information. Do not add explanations.
 
 Original text:
 {text}
 
 Rewritten text:"""
-        
-        return self._generate(prompt, max_new_tokens=200)
     
-    def _add_noise(self, text: str) -> str:
-        """Add realistic noise (typos, informal language)."""
-        prompt = f"""Rewrite the following text with minor realistic imperfections like:
+    def _noise_prompt(self, text: str) -> str:
+        """Prompt to add realistic noise (typos, informal language)."""
+        return f"""Rewrite the following text with minor realistic imperfections like:
 - 1-2 small typos
 - Slightly informal phrasing
 - Minor grammatical variations
@@ -125,60 +188,97 @@ Original text:
 {text}
 
 Noisy version:"""
-        
-        return self._generate(prompt, max_new_tokens=200)
     
-    def _make_formal(self, text: str) -> str:
-        """Make text more formal."""
-        prompt = f"""Rewrite the following text in a more formal, professional style. Keep all facts and entities unchanged.
+    def _formal_prompt(self, text: str) -> str:
+        """Prompt to make text more formal."""
+        return f"""Rewrite the following text in a more formal, professional style. Keep all facts and entities unchanged.
 
 Original text:
 {text}
 
 Formal version:"""
-        
-        return self._generate(prompt, max_new_tokens=200)
     
-    def _make_informal(self, text: str) -> str:
-        """Make text more informal."""
-        prompt = f"""Rewrite the following text in a more casual, conversational style. Keep all facts and entities unchanged.
+    def _informal_prompt(self, text: str) -> str:
+        """Prompt to make text more informal."""
+        return f"""Rewrite the following text in a more casual, conversational style. Keep all facts and entities unchanged.
 
 Original text:
 {text}
 
 Casual version:"""
+    
+    def _generate_batch(self, prompts: List[str], max_new_tokens: int = 200) -> List[str]:
+        """Generate text for several prompts, reusing cached generations when enabled."""
+        if self.cache_dir is None:
+            return self._run_model(prompts, max_new_tokens)
         
-        return self._generate(prompt, max_new_tokens=200)
+        results = [None] * len(prompts)
+        missing = []
+        for idx, prompt in enumerate(prompts):
+            cache_path = self._cache_path(prompt, max_new_tokens)
+            if cache_path.exists():
+                results[idx] = cache_path.read_text(encoding='utf-8')
+            else:
+                missing.append(idx)
+        
+        if missing:
+            generated = self._run_model([prompts[idx] for idx in missing], max_new_tokens)
+            for idx, text in zip(missing, generated):
+                # Write a temp file and rename it into place, so an interrupted
+                # run never leaves a truncated entry that later runs would serve
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                os.replace(tmp_path, self._cache_path(prompts[idx], max_new_tokens))
+                results[idx] = text
+        
+        return results
+    
+    def _cache_path(self, prompt: str, max_new_tokens: int) -> Path:
+        """Cache file for a prompt, keyed by model and generation settings."""
+        key = hashlib.sha1(
+            f"{self.model_name}\0{max_new_tokens}\0{prompt}".encode('utf-8')
+        ).hexdigest()
+        return self.cache_dir / f"{key}.txt"
     
-    def _generate(self, prompt: str, max_new_tokens: int = 200) -> str:
-        """Generate text using Qwen."""
-        messages = [
-            {"role": "user", "content": prompt}
+    def _run_model(self, prompts: List[str], max_new_tokens: int) -> List[str]:
+        """Generate text for several prompts in a single padded forward pass."""
+        texts = [
+            self.tokenizer.apply_chat_template(
+                [{"role": "user", "content": prompt}],
+                tokenize=False,
+                add_generation_prompt=True
+            )
+            for prompt in prompts
         ]
         
-        text = self.tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
-        )
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            return_tensors="pt"
+        ).to(self.model.device)
         
-        inputs = self.tokenizer([text], return_tensors="pt").to(self.model.device)
+        if self.deterministic:
+            sampling = {"do_sample": False}
+        else:
+            sampling = {"do_sample": True, "temperature": 0.7, "top_p": 0.9}
         
         with torch.no_grad():
             outputs = self.model.generate(
                 **inputs,
                 max_new_tokens=max_new_tokens,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True
+                pad_token_id=self.tokenizer.pad_token_id,
+                **sampling
             )
         
-        generated = self.tokenizer.decode(
-            outputs[0][inputs['input_ids'].shape[1]:],
+        # Prompts are left-padded, so every row's generation starts at the same offset
+        prompt_len = inputs['input_ids'].shape[1]
+        generated = self.tokenizer.batch_decode(
+            outputs[:, prompt_len:],
             skip_special_tokens=True
         )
         
-        return generated.strip()
+        return [text.strip() for text in generated]
     
     def _reconstruct_input(self, original_input: str, new_content: str) -> str:
         """Reconstruct canonical input with new content."""
@@ -203,7 +303,10 @@ def augment_dataset(
     input_file: str,
     output_file: str,
     num_augmentations: int = 2,
-    augmentation_types: List[str] = None
+    augmentation_types: List[str] = None,
+    batch_size: int = 16,
+    load_in_4bit: bool = False,
+    deterministic: bool = False
 ):
     """
     Augment entire dataset using Qwen.
@@ -213,6 +316,9 @@ def augment_dataset(
         output_file: Path to output augmented JSONL
         num_augmentations: Number of augmented variants per example
         augmentation_types: List of augmentation types to apply
+        batch_size: Number of prompts per generate call
+        load_in_4bit: Load the model with 4-bit NF4 weights
+        deterministic: Greedy decoding with an on-disk generation cache
     """
     if augmentation_types is None:
         augmentation_types = ["paraphrase", "noise"]
@@ -222,14 +328,14 @@ def augment_dataset(
     print(f"  Variants per example: {num_augmentations}")
     
     # Load model
-    augmenter = QwenAugmenter()
+    augmenter = QwenAugmenter(load_in_4bit=load_in_4bit, deterministic=deterministic)
     
     # Load examples
     examples = []
-    with open(input_file, 'r', encoding='utf-8') as f:
+    with open(input_file, 'rb') as f:
         for line in f:
             if line.strip():
-                examples.append(json.loads(line))
+                examples.append(orjson.loads(line))
     
     print(f"  Loaded {len(examples)} examples")
     
@@ -240,38 +346,49 @@ def augment_dataset(
     
     print(f"  Augmenting {len(sampled_examples)} examples...")
     
-    # Generate augmentations
-    augmented = []
-    for idx, example in enumerate(sampled_examples, 1):
-        print(f"  [{idx}/{len(sampled_examples)}] Augmenting...")
-        
+    # Pick augmentation types up front, then generate in batches
+    requests = []
+    for example in sampled_examples:
         for variant_num in range(num_augmentations):
             aug_type = random.choice(augmentation_types)
-            
-            try:
-                augmented_example = augmenter.augment_example(
-                    example,
-                    aug_type,
-                    variant_num
-                )
-                augmented.append(augmented_example)
+            requests.append((example, aug_type, variant_num))
+    
+    augmented = []
+    for start in range(0, len(requests), batch_size):
+        batch = requests[start:start + batch_size]
+        print(f"  [{start + len(batch)}/{len(requests)}] Augmenting batch of {len(batch)}...")
+        
+        try:
+            augmented_batch = augmenter.augment_batch(batch)
+            augmented.extend(augmented_batch)
+            for _, aug_type, variant_num in batch:
                 print(f"    ✓ Created {aug_type} variant {variant_num + 1}")
-            except Exception as e:
-                print(f"    ✗ Failed to create variant: {e}")
-                continue
+        except Exception as e:
+            # Retry one by one so a single bad example only loses its own variant
+            print(f"    ✗ Batch failed ({e}), retrying individually...")
+            for request in batch:
+                _, aug_type, variant_num = request
+                try:
+                    augmented.extend(augmenter.augment_batch([request]))
+                    print(f"    ✓ Created {aug_type} variant {variant_num + 1}")
+                except Exception as e:
+                    print(f"    ✗ Failed to create variant: {e}")
+                    continue
     
     # Save: original + augmented
     output_path = Path(output_file)
     output_path.parent.mkdir(parents=True, exist_ok=True)
     
-    with open(output_file, 'w', encoding='utf-8') as f:
+    with open(output_file, 'wb') as f:
         # Write original examples
         for example in examples:
-            f.write(json.dumps(example, ensure_ascii=False) + '\n')
+            f.write(orjson.dumps(example))
+            f.write(b'\n')
         
         # Write augmented examples
         for example in augmented:
-            f.write(json.dumps(example, ensure_ascii=False) + '\n')
+            f.write(orjson.dumps(example))
+            f.write(b'\n')
     
     total = len(examples) + len(augmented)
     print(f"\n✅ Augmentation complete!")
@@ -282,14 +399,24 @@ def augment_dataset(
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python3 scripts/qwen_augment.py <input.jsonl> <output.jsonl> [num_variants]")
+    deterministic = "--deterministic" in sys.argv
+    load_in_4bit = "--4bit" in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg not in ("--deterministic", "--4bit")]
+    
+    if len(args) < 2:
+        print("Usage: python3 scripts/qwen_augment.py <input.jsonl> <output.jsonl> [num_variants] [--deterministic] [--4bit]")
         print("\nExample:")
         print("  python3 scripts/qwen_augment.py data/train/template_01.jsonl data/train/augmented/template_01_aug.jsonl 2")
         sys.exit(1)
     
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
-    num_variants = int(sys.argv[3]) if len(sys.argv) > 3 else 2
+    input_file = args[0]
+    output_file = args[1]
+    num_variants = int(args[2]) if len(args) > 2 else 2
     
-    augment_dataset(input_file, output_file, num_variants)
\ No newline at end of file
+    augment_dataset(
+        input_file,
+        output_file,
+        num_variants,
+        load_in_4bit=load_in_4bit,
+        deterministic=deterministic
+    )
\ No newline at end of file
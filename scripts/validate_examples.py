@@ -3,38 +3,227 @@
 Enhanced validation with duplicate detection.
 """
 
+import argparse
+import hashlib
 import json
+import mmap
+import multiprocessing as mp
+import os
+import queue
 import sys
-from collections import defaultdict
-from typing import Dict, List, Set  # ADD THIS LINE
+import threading
+from collections import Counter, defaultdict
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
 from template_rules import TEMPLATE_RULES
 
+try:
+    import orjson as _json
+    
+    def _canonical_json(obj) -> bytes:
+        """Key-sorted JSON bytes, used to fingerprint outputs."""
+        return _json.dumps(obj, option=_json.OPT_SORT_KEYS)
+except ImportError:  # stdlib json also accepts bytes lines
+    _json = json
+    
+    def _canonical_json(obj) -> bytes:
+        """Key-sorted JSON bytes, used to fingerprint outputs."""
+        return json.dumps(obj, sort_keys=True).encode('utf-8')
+
+try:
+    import ahocorasick
+except ImportError:  # fall back to one substring scan per entity
+    ahocorasick = None
+
+try:
+    from xxhash import xxh3_64_intdigest as _fingerprint
+except ImportError:
+    def _fingerprint(data: bytes) -> int:
+        """64-bit fingerprint of data (blake2b fallback when xxhash is missing)."""
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+# Input normalization for ASCII text: lowercase and drop all whitespace
+# (the same characters str.split() treats as whitespace) in one translate()
+_ASCII_LOWER = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'abcdefghijklmnopqrstuvwxyz')
+_ASCII_WHITESPACE = b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f'
+
+# Below this many entities, per-entity `in` scans beat building an automaton
+_AHOCORASICK_MIN_ENTITIES = 5
+
+# Report messages by code; errors/warnings are stored as (code, args) and
+# only formatted when printed
+_MESSAGES = {
+    'invalid_json': "Line {}: Invalid JSON - {}",
+    'invalid_example': "Line {}: {}",
+    'abstention': "Line {}: No relations extracted (abstention) for {}",
+    'confidence_low': "Line {}: confidence {} < {} for {}",
+    'confidence_high': "Line {}: confidence {} > {} for {}",
+    'duplicate_input': "Line {}: Duplicate input detected",
+    'near_duplicate_input': "Line {}: Near-duplicate input (similar to line {})",
+    'duplicate_output': "Line {}: Duplicate output detected",
+    'entity_not_found': "Line {}: Entity '{}' not found in input",
+}
+
+# Warnings are counted per code; only this many (code, args) samples are kept
+_WARNING_SAMPLES = 20
+
+# Read-ahead double buffering: block size and number of blocks in flight
+_READ_AHEAD_BLOCK = 4 << 20
+_READ_AHEAD_DEPTH = 2
+
+# False-positive rate for the optional Bloom-filter duplicate tracking
+_BLOOM_ERROR_RATE = 1e-5
+
+# MinHash settings for optional near-duplicate detection
+_NEAR_DUP_NUM_PERM = 128
+_NEAR_DUP_SHINGLE = 5
+
+# template_id -> (allow_relations, allow_abstain, min_confidence, max_confidence)
+# Unset bounds become -inf/inf so the bounds check needs no None tests
+_COMPILED_RULES = {
+    template_id: (
+        rules.get('allow_relations', False),
+        rules.get('allow_abstain', True),
+        float('-inf') if rules.get('min_confidence') is None else rules['min_confidence'],
+        float('inf') if rules.get('max_confidence') is None else rules['max_confidence'],
+    )
+    for template_id, rules in TEMPLATE_RULES.items()
+}
+
+
+class _BloomFingerprints:
+    """Fixed-size approximate stand-in for a fingerprint -> line number dict.
+    
+    Supports the `in` / item assignment used by duplicate checks; line
+    numbers are not kept and membership may report rare false positives.
+    """
+    
+    def __init__(self, capacity: int):
+        from pybloomfilter import BloomFilter
+        self._bloom = BloomFilter(capacity, _BLOOM_ERROR_RATE)
+    
+    def __contains__(self, fingerprint: int) -> bool:
+        return fingerprint in self._bloom
+    
+    def __setitem__(self, fingerprint: int, line_no: int):
+        self._bloom.add(fingerprint)
+
 
 class ExampleValidator:
-    def __init__(self):
-        self.errors = []
-        self.warnings = []
-        self.seen_inputs: Set[str] = set()
-        self.seen_outputs: Set[str] = set()
-    
-    def validate_file(self, filepath: str):
-        """Validate entire file."""
+    def __init__(
+        self,
+        near_dup_threshold: Optional[float] = None,
+        bloom_capacity: Optional[int] = None,
+        read_ahead: bool = False
+    ):
+        self.read_ahead = read_ahead
+        self.errors: List[Tuple[str, tuple]] = []
+        # Warning code -> count, and the first _WARNING_SAMPLES args per code
+        self.warning_counts: Counter = Counter()
+        self.warning_samples: Dict[str, List[tuple]] = defaultdict(list)
+        # 64-bit fingerprint -> line number where it was first seen
+        if bloom_capacity is None:
+            self.seen_inputs: Dict[int, int] = {}
+            self.seen_outputs: Dict[int, int] = {}
+        else:
+            # Bounded memory for very large corpora, at the cost of exactness
+            self.seen_inputs = _BloomFingerprints(bloom_capacity)
+            self.seen_outputs = _BloomFingerprints(bloom_capacity)
+        
+        # MinHash LSH index over inputs, only when near-dup detection is requested
+        self.near_dup_lsh = None
+        if near_dup_threshold is not None:
+            from datasketch import MinHash, MinHashLSH
+            self.near_dup_lsh = MinHashLSH(
+                threshold=near_dup_threshold,
+                num_perm=_NEAR_DUP_NUM_PERM
+            )
+            # Empty MinHash whose copies share its permutations, so they are
+            # generated once rather than per example
+            self._near_dup_empty = MinHash(num_perm=_NEAR_DUP_NUM_PERM, seed=42)
+    
+    def validate_file(self, filepath: str, jobs: int = 1) -> bool:
+        """Validate entire file. Returns True when no errors were found."""
         print(f"Validating {filepath}...")
         
-        with open(filepath, 'r', encoding='utf-8') as f:
-            for line_no, line in enumerate(f, start=1):
-                if not line.strip():
-                    continue
-                
-                try:
-                    example = json.loads(line)
-                    self.validate_example(example, line_no)
-                except json.JSONDecodeError as e:
-                    self.errors.append(f"Line {line_no}: Invalid JSON - {e}")
-                except Exception as e:
-                    self.errors.append(f"Line {line_no}: {e}")
+        if jobs > 1:
+            self._validate_parallel(filepath, jobs)
+        else:
+            self._validate_range(filepath, 0, None, 1)
+        
+        return self._report()
+    
+    def _validate_range(self, filepath: str, start: int, end: Optional[int], first_line_no: int):
+        """Validate the lines in bytes [start, end) of a file (end=None: to EOF)."""
+        if self.read_ahead:
+            lines = _read_ahead_lines(filepath, start, end)
+            for line_no, line in enumerate(lines, start=first_line_no):
+                self._validate_line(line, line_no)
+            return
+        
+        # Large binary buffer: no per-line text decode, fewer read syscalls
+        with open(filepath, 'rb', buffering=1 << 20) as f:
+            f.seek(start)
+            pos = start
+            for line_no, line in enumerate(f, start=first_line_no):
+                if end is not None and pos >= end:
+                    break
+                pos += len(line)
+                self._validate_line(line, line_no)
+    
+    def _validate_line(self, line: bytes, line_no: int):
+        """Parse and validate one raw JSONL line, recording any error."""
+        if not line or line.isspace():
+            return
         
-        self._report()
+        try:
+            example = _json.loads(line)
+            self.validate_example(example, line_no)
+        except _json.JSONDecodeError as e:
+            self.errors.append(('invalid_json', (line_no, str(e))))
+        except Exception as e:
+            self.errors.append(('invalid_example', (line_no, str(e))))
+    
+    def _validate_parallel(self, filepath: str, jobs: int):
+        """Validate newline-aligned chunks in worker processes and merge results."""
+        tasks = [(filepath, *chunk, self.read_ahead) for chunk in _split_lines(filepath, jobs)]
+        with mp.Pool(jobs) as pool:
+            results = pool.map(_validate_chunk, tasks)
+        
+        for errors, warning_counts, warning_samples, seen_inputs, seen_outputs in results:
+            self.errors.extend(errors)
+            
+            # Chunks only dedupe internally; catch repeats of earlier chunks here
+            cross_samples = defaultdict(list)
+            for code, chunk_seen, seen in (
+                ('duplicate_input', seen_inputs, self.seen_inputs),
+                ('duplicate_output', seen_outputs, self.seen_outputs),
+            ):
+                for fingerprint, line_no in chunk_seen.items():
+                    if fingerprint in seen:
+                        warning_counts[code] += 1
+                        if len(cross_samples[code]) < _WARNING_SAMPLES:
+                            cross_samples[code].append((line_no,))
+                    else:
+                        seen[fingerprint] = line_no
+            
+            # Merge this chunk's samples in line order so the report keeps the
+            # first warnings in the file
+            self.warning_counts.update(warning_counts)
+            for code in warning_samples.keys() | cross_samples.keys():
+                samples = sorted(
+                    warning_samples.get(code, []) + cross_samples[code],
+                    key=lambda args: args[0]
+                )
+                kept = self.warning_samples[code]
+                kept.extend(samples[:_WARNING_SAMPLES - len(kept)])
+    
+    def _warn(self, code: str, *args):
+        """Count a warning, keeping its args only among the first few per code."""
+        self.warning_counts[code] += 1
+        samples = self.warning_samples[code]
+        if len(samples) < _WARNING_SAMPLES:
+            samples.append(args)
     
     def validate_example(self, example: Dict, line_no: int):
         """Validate single example."""
@@ -44,7 +233,8 @@ class ExampleValidator:
         
         template_id = example['template_id']
         
-        if template_id not in TEMPLATE_RULES:
+        rules = _COMPILED_RULES.get(template_id)
+        if rules is None:
             raise ValueError(f"unknown template_id: {template_id}")
         
         if 'input' not in example:
@@ -62,7 +252,7 @@ class ExampleValidator:
             raise ValueError("missing relations in output")
         
         # Validate against template rules
-        self._validate_template_rules(example, template_id, line_no)
+        self._validate_template_rules(example, template_id, rules, line_no)
         
         # Check for duplicates
         self._check_duplicates(example, line_no)
@@ -70,122 +260,284 @@ class ExampleValidator:
         # Validate entity-relation consistency
         self._validate_consistency(example, line_no)
     
-    def _validate_template_rules(self, example: Dict, template_id: str, line_no: int):
+    def _validate_template_rules(self, example: Dict, template_id: str, rules: Tuple, line_no: int):
         """Validate example follows template rules."""
-        rules = TEMPLATE_RULES[template_id]
+        allow_relations, allow_abstain, min_conf, max_conf = rules
         relations = example['output']['relations']
         
         # Check if relations are allowed
-        if not rules.get('allow_relations', False) and relations:
+        if not allow_relations and relations:
             raise ValueError(
                 f"relations not allowed for {template_id}"
             )
         
         # Check abstention rules
-        if not rules.get('allow_abstain', True) and not relations:
-            self.warnings.append(
-                f"Line {line_no}: No relations extracted (abstention) for {template_id}"
-            )
+        if not allow_abstain and not relations:
+            self._warn('abstention', line_no, template_id)
         
         # Check confidence ranges
         if relations:
-            for rel in relations:
-                conf = rel.get('confidence')
+            confs = [rel.get('confidence') for rel in relations]
+            
+            # Fast path: all scores present and within bounds (min/max run in C)
+            if None not in confs and min_conf <= min(confs) and max(confs) <= max_conf:
+                return
+            
+            for conf in confs:
                 if conf is None:
                     raise ValueError("relation missing confidence score")
                 
-                min_conf = rules.get('min_confidence')
-                max_conf = rules.get('max_confidence')
-                
-                if min_conf and conf < min_conf:
-                    self.warnings.append(
-                        f"Line {line_no}: confidence {conf} < {min_conf} for {template_id}"
-                    )
+                if conf < min_conf:
+                    self._warn('confidence_low', line_no, conf, min_conf, template_id)
                 
-                if max_conf and conf > max_conf:
-                    self.warnings.append(
-                        f"Line {line_no}: confidence {conf} > {max_conf} for {template_id}"
-                    )
+                if conf > max_conf:
+                    self._warn('confidence_high', line_no, conf, max_conf, template_id)
     
     def _check_duplicates(self, example: Dict, line_no: int):
         """Check for duplicate examples."""
         # Create fingerprint of input (normalized)
-        input_text = example['input'].strip().lower()
-        input_fingerprint = ''.join(input_text.split())
+        input_text = example['input']
+        if input_text.isascii():
+            normalized = input_text.encode('ascii').translate(_ASCII_LOWER, _ASCII_WHITESPACE)
+        else:
+            normalized = ''.join(input_text.lower().split()).encode('utf-8')
+        input_fingerprint = _fingerprint(normalized)
         
         if input_fingerprint in self.seen_inputs:
-            self.warnings.append(
-                f"Line {line_no}: Duplicate input detected"
-            )
+            self._warn('duplicate_input', line_no)
         else:
-            self.seen_inputs.add(input_fingerprint)
+            self.seen_inputs[input_fingerprint] = line_no
+            if self.near_dup_lsh is not None:
+                self._check_near_duplicates(normalized, line_no)
         
         # Check output fingerprint
-        output_str = json.dumps(example['output'], sort_keys=True)
-        if output_str in self.seen_outputs:
-            self.warnings.append(
-                f"Line {line_no}: Duplicate output detected"
-            )
+        output_fingerprint = _fingerprint(_canonical_json(example['output']))
+        if output_fingerprint in self.seen_outputs:
+            self._warn('duplicate_output', line_no)
         else:
-            self.seen_outputs.add(output_str)
+            self.seen_outputs[output_fingerprint] = line_no
+    
+    def _check_near_duplicates(self, normalized_input: bytes, line_no: int):
+        """Flag inputs whose character shingles are similar to an earlier input."""
+        shingles = {
+            normalized_input[i:i + _NEAR_DUP_SHINGLE]
+            for i in range(max(1, len(normalized_input) - _NEAR_DUP_SHINGLE + 1))
+        }
+        minhash = self._near_dup_empty.copy()
+        minhash.update_batch(shingles)
+        
+        matches = self.near_dup_lsh.query(minhash)
+        if matches:
+            self._warn('near_duplicate_input', line_no, min(matches))
+        self.near_dup_lsh.insert(line_no, minhash)
     
     def _validate_consistency(self, example: Dict, line_no: int):
         """Validate entity-relation consistency."""
-        entities = example['output']['entities']
-        relations = example['output']['relations']
+        output = example['output']
+        entities = output['entities']
+        relations = output['relations']
         input_text = example['input']
         
-        # Build entity ID set
-        entity_ids = {e['id'] for e in entities}
-        
-        # Check relation references
-        for rel in relations:
-            if rel['source_id'] not in entity_ids:
-                raise ValueError(f"invalid source_id: {rel['source_id']}")
-            
-            if rel['target_id'] not in entity_ids:
-                raise ValueError(f"invalid target_id: {rel['target_id']}")
+        # Check relation references (no ID set needed without relations)
+        if relations:
+            entity_ids = frozenset(e['id'] for e in entities)
+            for rel in relations:
+                source_id = rel['source_id']
+                target_id = rel['target_id']
+                if source_id not in entity_ids or target_id not in entity_ids:
+                    if source_id not in entity_ids:
+                        raise ValueError(f"invalid source_id: {source_id}")
+                    raise ValueError(f"invalid target_id: {target_id}")
         
         # Check if entity texts appear in input
-        for entity in entities:
-            if entity['text'] not in input_text:
-                self.warnings.append(
-                    f"Line {line_no}: Entity '{entity['text']}' not found in input"
-                )
+        for text in self._missing_entity_texts(entities, input_text):
+            self._warn('entity_not_found', line_no, text)
+    
+    def _missing_entity_texts(self, entities: List[Dict], input_text: str) -> List[str]:
+        """Entity texts (in entity order) that do not occur in the input."""
+        texts = [entity['text'] for entity in entities]
+        # Repeated entity texts are looked up once per example
+        unique_texts = set(texts)
+        
+        if ahocorasick is None or len(unique_texts) < _AHOCORASICK_MIN_ENTITIES:
+            absent = {text for text in unique_texts if text not in input_text}
+        else:
+            # One linear scan of the input for all entity texts
+            automaton = ahocorasick.Automaton()
+            for text in unique_texts:
+                if text:
+                    automaton.add_word(text, text)
+            automaton.make_automaton()
+            found = {text for _, text in automaton.iter(input_text)}
+            absent = {text for text in unique_texts if text and text not in found}
+        
+        if not absent:
+            return []
+        return [text for text in texts if text in absent]
     
-    def _report(self):
-        """Print validation report."""
+    def _report(self) -> bool:
+        """Print validation report. Returns True when there are no errors."""
         print("\n" + "="*60)
         print("VALIDATION REPORT")
         print("="*60)
         
         if self.errors:
             print(f"\n❌ ERRORS ({len(self.errors)}):")
-            for error in self.errors[:20]:  # Show first 20
-                print(f"  - {error}")
+            for code, args in islice(self.errors, 20):  # Show first 20
+                print("  - " + _MESSAGES[code].format(*args))
             if len(self.errors) > 20:
                 print(f"  ... and {len(self.errors) - 20} more")
         
-        if self.warnings:
-            print(f"\n⚠️  WARNINGS ({len(self.warnings)}):")
-            for warning in self.warnings[:20]:
-                print(f"  - {warning}")
-            if len(self.warnings) > 20:
-                print(f"  ... and {len(self.warnings) - 20} more")
+        num_warnings = sum(self.warning_counts.values())
+        if num_warnings:
+            print(f"\n⚠️  WARNINGS ({num_warnings}):")
+            for code, count in self.warning_counts.most_common():
+                samples = self.warning_samples[code]
+                print(f"  {code}: {count}")
+                for args in samples:
+                    print("    - " + _MESSAGES[code].format(*args))
+                if count > len(samples):
+                    print(f"    ... and {count - len(samples)} more")
         
-        if not self.errors and not self.warnings:
+        if not self.errors and not num_warnings:
             print("\n✅ All validations passed!")
         elif not self.errors:
-            print(f"\n✅ No errors, but {len(self.warnings)} warnings")
+            print(f"\n✅ No errors, but {num_warnings} warnings")
         else:
             print(f"\n❌ Validation failed with {len(self.errors)} errors")
-            sys.exit(1)
+        
+        return not self.errors
+
+
+def _split_lines(filepath: str, jobs: int) -> List[Tuple[int, int, int]]:
+    """Split a file into up to `jobs` newline-aligned (start, end, first_line_no) ranges."""
+    size = os.path.getsize(filepath)
+    if size == 0:
+        return [(0, 0, 1)]
+    
+    # Memory-map the file: newline search and counting run over the page
+    # cache without read() calls or a line-by-line pass
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets = [0]
+        for i in range(1, jobs):
+            target = max(offsets[-1], size * i // jobs)
+            if target == 0:
+                continue
+            # Search from one byte back so a target already at a line start stays put
+            newline = mm.find(b'\n', target - 1)
+            if newline == -1 or newline + 1 >= size:
+                break
+            if newline + 1 > offsets[-1]:
+                offsets.append(newline + 1)
+        offsets.append(size)
+        
+        # Count newlines per chunk so workers can report absolute line numbers
+        chunks = []
+        line_no = 1
+        for start, end in zip(offsets, offsets[1:]):
+            chunks.append((start, end, line_no))
+            for block_start in range(start, end, 1 << 20):
+                line_no += mm[block_start:min(block_start + (1 << 20), end)].count(b'\n')
+    
+    return chunks
+
+
+def _read_ahead_lines(filepath: str, start: int, end: Optional[int]) -> Iterator[bytes]:
+    """Yield the lines in bytes [start, end) without their newlines.
+    
+    A background thread reads the next blocks while the caller validates the
+    current one, overlapping disk reads with parsing (read() releases the GIL).
+    """
+    blocks = queue.Queue(maxsize=_READ_AHEAD_DEPTH)
+    
+    def reader():
+        try:
+            with open(filepath, 'rb', buffering=0) as f:
+                f.seek(start)
+                remaining = None if end is None else end - start
+                while remaining is None or remaining > 0:
+                    size = _READ_AHEAD_BLOCK if remaining is None else min(remaining, _READ_AHEAD_BLOCK)
+                    block = f.read(size)
+                    if not block:
+                        break
+                    if remaining is not None:
+                        remaining -= len(block)
+                    blocks.put(block)
+            blocks.put(None)
+        except Exception as e:
+            blocks.put(e)
+    
+    threading.Thread(target=reader, daemon=True).start()
+    
+    tail = b''
+    while True:
+        block = blocks.get()
+        if block is None:
+            break
+        if isinstance(block, Exception):
+            raise block
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        yield from lines
+    
+    if tail:
+        yield tail
+
+
+def _validate_chunk(task: Tuple[str, int, int, int, bool]):
+    """Pool worker: validate one chunk and return its raw results."""
+    filepath, start, end, first_line_no, read_ahead = task
+    validator = ExampleValidator(read_ahead=read_ahead)
+    validator._validate_range(filepath, start, end, first_line_no)
+    return (
+        validator.errors,
+        validator.warning_counts,
+        dict(validator.warning_samples),
+        validator.seen_inputs,
+        validator.seen_outputs
+    )
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python3 scripts/validate_examples.py <jsonl_file>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="Validate a training JSONL file.")
+    parser.add_argument("jsonl_file", help="Path to the JSONL file to validate")
+    parser.add_argument(
+        "--near-dup-threshold",
+        type=float,
+        default=None,
+        help="Also warn on near-duplicate inputs at this Jaccard similarity "
+             "(MinHash LSH, requires datasketch)"
+    )
+    parser.add_argument(
+        "--bloom",
+        type=int,
+        default=None,
+        metavar="CAPACITY",
+        help="Track seen inputs/outputs in Bloom filters sized for CAPACITY lines "
+             "(approximate, requires pybloomfiltermmap3)"
+    )
+    parser.add_argument(
+        "--read-ahead",
+        action="store_true",
+        help="Read the next blocks in a background thread while validating"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Validate in this many worker processes (default: 1)"
+    )
+    args = parser.parse_args()
+    
+    if args.jobs > 1 and args.near_dup_threshold is not None:
+        parser.error("--near-dup-threshold needs the whole file in one process; use --jobs 1")
+    if args.jobs > 1 and args.bloom is not None:
+        parser.error("--bloom cannot merge results across workers; use --jobs 1")
     
-    validator = ExampleValidator()
-    validator.validate_file(sys.argv[1])
\ No newline at end of file
+    validator = ExampleValidator(
+        near_dup_threshold=args.near_dup_threshold,
+        bloom_capacity=args.bloom,
+        read_ahead=args.read_ahead
+    )
+    if not validator.validate_file(args.jsonl_file, jobs=args.jobs):
+        sys.exit(1)
\ No newline at end of file